@@ -23,7 +23,7 @@ class TransformLoader:
             method = add_transforms.ImageJitter(self.jitter_param)
             return method
         method = getattr(transforms, transform_type)
-        if transform_type == 'RandomSizedCrop':
+        if transform_type == 'RandomResizedCrop':
             return method(self.image_size)
         elif transform_type == 'CenterCrop':
             return method(self.image_size)
@@ -36,7 +36,7 @@ class TransformLoader:
 
     def get_composed_transform(self, aug=False):
         if aug:
-            transform_list = ['RandomSizedCrop', 'ImageJitter', 'RandomHorizontalFlip', 'ToTensor', 'Normalize']
+            transform_list = ['RandomResizedCrop', 'ImageJitter', 'RandomHorizontalFlip', 'ToTensor', 'Normalize']
         else:
             transform_list = ['Resize', 'CenterCrop', 'ToTensor', 'Normalize']
 
@@ -52,20 +52,65 @@ class DataManager:
 
 
 class SimpleDataManager(DataManager):
-    def __init__(self, image_size, batch_size):
+    def __init__(self, image_size, batch_size, num_workers=12):
         super(SimpleDataManager, self).__init__()
         self.batch_size = batch_size
+        self.num_workers = num_workers
         self.trans_loader = TransformLoader(image_size)
 
-    def get_data_loader(self, data_file, aug):  # parameters that would change on train/val set
+    def get_data_loader(self, data_file, aug, distributed=False, drop_last=False, pin_memory=False,
+                        persistent_workers=False):  # parameters that would change on train/val set
         transform = self.trans_loader.get_composed_transform(aug)
         dataset = SimpleDataset(data_file, transform)
-        data_loader_params = dict(batch_size=self.batch_size, shuffle=True, num_workers=12)
+        data_loader_params = dict(batch_size=self.batch_size, num_workers=self.num_workers,
+                                  pin_memory=pin_memory and torch.cuda.is_available(), drop_last=drop_last)
+        if distributed:
+            # each rank reads its own shard; the sampler does the shuffling
+            data_loader_params['sampler'] = torch.utils.data.distributed.DistributedSampler(dataset)
+        else:
+            data_loader_params['shuffle'] = True
+        if persistent_workers and self.num_workers > 0:
+            # keep workers alive across epochs for loaders that are iterated many times
+            data_loader_params.update(persistent_workers=True, prefetch_factor=4)
         data_loader = torch.utils.data.DataLoader(dataset, **data_loader_params)
 
         return data_loader
 
 
+class CudaPrefetcher:
+    # copies the next batch to the GPU on a side stream while the current one is being consumed
+    def __init__(self, loader):
+        self.loader = loader
+        self.stream = torch.cuda.Stream()
+
+    @property
+    def sampler(self):
+        return self.loader.sampler
+
+    def __len__(self):
+        return len(self.loader)
+
+    def preload(self, it):
+        try:
+            batch = next(it)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            return [t.cuda(non_blocking=True) for t in batch]
+
+    def __iter__(self):
+        it = iter(self.loader)
+        batch = self.preload(it)
+        while batch is not None:
+            current_stream = torch.cuda.current_stream()
+            current_stream.wait_stream(self.stream)
+            for t in batch:
+                t.record_stream(current_stream)
+            next_batch = self.preload(it)
+            yield batch
+            batch = next_batch
+
+
 class SetDataManager(DataManager):
     def __init__(self, image_size, n_way, n_support, n_query, n_eposide=100):
         super(SetDataManager, self).__init__()
@@ -25,9 +25,18 @@ def parse_args(script):
         parser.add_argument('--resume', action='store_true',
                             help='continue from previous trained model with largest epoch')
         parser.add_argument('--lr', default=0.001, type=int, help='learning rate')
-        parser.add_argument('--batch_size', default=16, type=int, help='batch size ')
+        parser.add_argument('--batch_size', default=16, type=int, help='global batch size, split across GPUs/ranks')
         parser.add_argument('--test_batch_size', default=2, type=int, help='batch size ')
         parser.add_argument('--alpha', default=2.0, type=int, help='for S2M2 training ')
+        parser.add_argument('--num_workers', default=12, type=int, help='dataloader workers per process')
+        parser.add_argument('--cuda_graph', action='store_true',
+                            help='replay the rotation training step as a CUDA graph; rotation method, single GPU '
+                                 'and bfloat16/float32 only, anything else is rejected')
+        parser.add_argument('--compile', action='store_true',
+                            help='compile the backbone stages with torch.compile (inductor); '
+                                 'on more than one GPU this requires a torchrun (DDP) launch')
+        parser.add_argument('--amp_dtype', default='bfloat16', choices=['bfloat16', 'float16', 'float32'],
+                            help='autocast dtype (float32 disables autocast)')
     elif script == 'test':
         parser.add_argument('--num_classes', default=200, type=int, help='total number of classes')
 
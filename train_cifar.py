@@ -7,32 +7,143 @@
 from __future__ import print_function
 
 import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim as optim
-from torch.autograd import Variable
 
 import configs
 import res_mixup_model
 import wrn_mixup_model
-from data.datamgr import SimpleDataManager
+from data.datamgr import SimpleDataManager, CudaPrefetcher
 from io_utils import parse_args, get_resume_file
 
 use_gpu = torch.cuda.is_available()
 
 
+def get_amp_config(params):
+    # bf16 keeps the fp32 exponent range, so only fp16 needs loss scaling
+    amp_dtype = getattr(torch, params.amp_dtype)
+    use_amp = use_gpu and amp_dtype != torch.float32
+    scaler = torch.amp.GradScaler('cuda', enabled=use_amp and amp_dtype == torch.float16)
+    return amp_dtype, use_amp, scaler
+
+
+def capture_cuda_graph(step_fn, modules, optimizer, *static_inputs, warmup=3):
+    # the warm-up steps really update weights, BN stats and Adam moments, so snapshot them first and put them
+    # back in place afterwards; the first batch is then trained once, by the first replay
+    module_states = [{k: v.clone() for k, v in m.state_dict().items()} for m in modules]
+    optim_states = {p: {k: v.clone() for k, v in state.items() if torch.is_tensor(v)}
+                    for p, state in optimizer.state.items()}
+
+    # warm up on a side stream so cuDNN plans and optimizer state exist before capture
+    side_stream = torch.cuda.Stream()
+    side_stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(side_stream):
+        for _ in range(warmup):
+            step_fn(*static_inputs)
+    torch.cuda.current_stream().wait_stream(side_stream)
+
+    for m, state in zip(modules, module_states):
+        m.load_state_dict(state)
+    with torch.no_grad():
+        # restore in place: the captured step must keep using the tensors the warm-up allocated
+        for p, state in optimizer.state.items():
+            saved = optim_states.get(p, {})
+            for k, v in state.items():
+                if not torch.is_tensor(v):
+                    continue
+                if k in saved:
+                    v.copy_(saved[k])
+                else:
+                    v.zero_()
+
+    # grads must be allocated from the graph's private pool
+    optimizer.zero_grad(set_to_none=True)
+    graph = torch.cuda.CUDAGraph()
+    # the DataLoader pin-memory thread keeps allocating pinned buffers during capture; thread_local mode
+    # only forbids unsafe CUDA calls from this thread
+    with torch.cuda.graph(graph, capture_error_mode='thread_local'):
+        static_outputs = step_fn(*static_inputs)
+    return graph, static_outputs
+
+
+def compile_backbone(model, params):
+    # the top-level forward picks the mixup layer on the host, so only the fixed-shape stages are compiled;
+    # Module.compile works in place and keeps the checkpoint keys unchanged
+    if params.model == 'WideResNet28_10':
+        stages = [model.block1, model.block2, model.block3]
+    else:
+        stages = [model.layer1, model.layer2, model.layer3, model.layer4]
+    # inductor's own CUDA graphs cannot nest inside the manually captured rotation step; __main__ only lets
+    # --cuda_graph through when that capture actually happens
+    mode = 'max-autotune-no-cudagraphs' if params.cuda_graph else 'max-autotune'
+    for stage in stages:
+        stage.compile(mode=mode, dynamic=False)
+
+
+def cpu_state_dict(module):
+    # always a real copy (.cpu() aliases CPU tensors), so the writer thread never sees in-place updates
+    return {k: v.detach().to('cpu', copy=True) for k, v in module.state_dict().items()}
+
+
+def load_checkpoint(checkpoint_file, map_location):
+    # mmap needs the zipfile format; checkpoints written by torch<1.6 (legacy format) are read normally
+    mmap = zipfile.is_zipfile(checkpoint_file)
+    return torch.load(checkpoint_file, map_location=map_location, mmap=mmap)
+
+
+def is_main_process(params):
+    return not params.distributed or torch.distributed.get_rank() == 0
+
+
+def wrap_model(model, params):
+    if params.distributed:
+        model = model.cuda(params.local_rank)
+        return torch.nn.parallel.DistributedDataParallel(model, device_ids=[params.local_rank])
+    # single-process fallback when not launched through torchrun
+    if use_gpu:
+        model = torch.nn.DataParallel(model, device_ids=range(torch.cuda.device_count()))
+        model.cuda()
+    return model
+
+
+def rotate_batch(x, y, angles):
+    # each sample is followed by its 90/180/270 degree rotations; keeping this sample-major order means
+    # every DataParallel replica still sees all four angles in its chunk of the batch
+    bs, c, h, w = x.size()
+    x_ = torch.stack([x.rot90(k, (2, 3)) for k in range(4)], dim=1).reshape(4 * bs, c, h, w)
+    # NHWC lets cuDNN pick the tensor-core conv kernels under autocast
+    x_ = x_.contiguous(memory_format=torch.channels_last)
+    # labels in the same order: y.repeat_interleave(4) (via expand, no host sync) and [0, 1, 2, 3] * bs
+    y_ = y[:, None].expand(bs, 4).reshape(-1)
+    a_ = angles.repeat(bs)
+    return x_, y_, a_
+
+
 def train_manifold_mixup(base_loader, base_loader_test, model, start_epoch, stop_epoch, params):
-    def mixup_criterion(criterion, pred, y_a, y_b, lam):
-        return lam * criterion(pred, y_a) + (1 - lam) * criterion(pred, y_b)
+    def mixup_criterion(pred, y_a, y_b, lam):
+        # both targets share one log_softmax pass over the logits
+        logp = F.log_softmax(pred, dim=1)
+        return lam * F.nll_loss(logp, y_a) + (1 - lam) * F.nll_loss(logp, y_b)
 
     criterion = nn.CrossEntropyLoss()
-    optimizer = optim.Adam(model.parameters())
-    print("stop_epoch", start_epoch, stop_epoch)
+    optimizer = optim.Adam(model.parameters(), fused=use_gpu)
+    amp_dtype, use_amp, scaler = get_amp_config(params)
+    saver = ThreadPoolExecutor(max_workers=1)
+    pending_save = None
+    if is_main_process(params):
+        print("stop_epoch", start_epoch, stop_epoch)
 
     for epoch in range(start_epoch, stop_epoch):
-        print('\nEpoch: %d' % epoch)
+        if is_main_process(params):
+            print('\nEpoch: %d' % epoch)
+        if params.distributed:
+            base_loader.sampler.set_epoch(epoch)
 
         model.train()
         train_loss = 0
@@ -43,54 +154,58 @@ def train_manifold_mixup(base_loader, base_loader_test, model, start_epoch, stop
 
         for batch_idx, (input_var, target_var) in enumerate(base_loader):
             if use_gpu:
-                input_var, target_var = input_var.cuda(), target_var.cuda()
-            input_var, target_var = Variable(input_var), Variable(target_var)
+                input_var, target_var = input_var.cuda(non_blocking=True), target_var.cuda(non_blocking=True)
             lam = np.random.beta(params.alpha, params.alpha)
-            _, outputs, target_a, target_b = model(input_var, target_var, mixup_hidden=True, mixup_alpha=params.alpha,
-                                                   lam=lam)
-            loss = mixup_criterion(criterion, outputs, target_a, target_b, lam)
-            train_loss += loss.data.item()
-            _, predicted = torch.max(outputs.data, 1)
+            with torch.autocast('cuda', dtype=amp_dtype, enabled=use_amp):
+                _, outputs, target_a, target_b = model(input_var, target_var, mixup_hidden=True,
+                                                       mixup_alpha=params.alpha, lam=lam)
+                loss = mixup_criterion(outputs, target_a, target_b, lam)
+            # running stats stay on the device and are only synced when printed
+            train_loss += loss.detach()
+            _, predicted = torch.max(outputs, 1)
             total += target_var.size(0)
-            correct += (lam * predicted.eq(target_a.data).cpu().sum().float()
-                        + (1 - lam) * predicted.eq(target_b.data).cpu().sum().float())
+            correct += lam * predicted.eq(target_a).sum() + (1 - lam) * predicted.eq(target_b).sum()
 
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
 
-            if batch_idx % 100 == 0:
+            if batch_idx % 100 == 0 and is_main_process(params):
                 print('{0}/{1}'.format(batch_idx, len(base_loader)), 'Loss: %.3f | Acc: %.3f%% '
-                      % (train_loss / (batch_idx + 1), 100. * correct / total))
+                      % (train_loss.item() / (batch_idx + 1), 100. * correct.item() / total))
 
-        if not os.path.isdir(params.checkpoint_dir):
-            os.makedirs(params.checkpoint_dir)
-
-        if (epoch % params.save_freq == 0) or (epoch == stop_epoch - 1):
+        if ((epoch % params.save_freq == 0) or (epoch == stop_epoch - 1)) and is_main_process(params):
             outfile = os.path.join(params.checkpoint_dir, '{:d}.tar'.format(epoch))
-            torch.save({'epoch': epoch, 'state': model.state_dict()}, outfile)
-
-        model.eval()
-        with torch.no_grad():
-            test_loss = 0
-            correct = 0
-            total = 0
-            for batch_idx, (inputs, targets) in enumerate(base_loader_test):
-                if use_gpu:
-                    inputs, targets = inputs.cuda(), targets.cuda()
-                inputs, targets = Variable(inputs), Variable(targets)
-                f, outputs = model.forward(inputs)
-                loss = criterion(outputs, targets)
-                test_loss += loss.data.item()
-                _, predicted = torch.max(outputs.data, 1)
-                total += targets.size(0)
-                correct += predicted.eq(targets.data).cpu().sum()
-
-            print('Loss: %.3f | Acc: %.3f%%'
-                  % (test_loss / (batch_idx + 1), 100. * correct / total))
-
-        torch.cuda.empty_cache()
-
+            if pending_save is not None:
+                pending_save.result()
+            pending_save = saver.submit(torch.save, {'epoch': epoch, 'state': cpu_state_dict(model)}, outfile)
+
+        if is_main_process(params):
+            # one rank evaluates the unwrapped module, so no collective is issued from here
+            eval_model = model.module if params.distributed else model
+            eval_model.eval()
+            with torch.no_grad():
+                device = 'cuda' if use_gpu else 'cpu'
+                test_loss = torch.zeros((), device=device)
+                correct = torch.zeros((), dtype=torch.long, device=device)
+                total = 0
+                for batch_idx, (inputs, targets) in enumerate(base_loader_test):
+                    if use_gpu:
+                        inputs, targets = inputs.cuda(non_blocking=True), targets.cuda(non_blocking=True)
+                    f, outputs = eval_model.forward(inputs)
+                    loss = criterion(outputs, targets)
+                    test_loss += loss
+                    _, predicted = torch.max(outputs, 1)
+                    total += targets.size(0)
+                    correct += predicted.eq(targets).sum()
+
+                print('Loss: %.3f | Acc: %.3f%%'
+                      % (test_loss.item() / (batch_idx + 1), 100. * correct.item() / total))
+
+    saver.shutdown(wait=True)
+    if pending_save is not None:
+        pending_save.result()
     return model
 
 
@@ -107,17 +222,50 @@ def train_rotation(base_loader, base_loader_test, model, start_epoch, stop_epoch
         print("loading rotate model")
         rotate_classifier.load_state_dict(tmp['rotate'])
 
+    rotate_head = rotate_classifier
+    if params.distributed:
+        rotate_classifier = torch.nn.parallel.DistributedDataParallel(rotate_classifier,
+                                                                      device_ids=[params.local_rank])
+
+    amp_dtype, use_amp, scaler = get_amp_config(params)
+    # the whole step is replayed as one graph; __main__ has already rejected setups that cannot be captured
+    use_graph = params.cuda_graph
+    graph = None
+
     optimizer = torch.optim.Adam([
         {'params': model.parameters()},
         {'params': rotate_classifier.parameters()}
-    ])
+    ], fused=use_gpu, capturable=use_graph)
 
     lossfn = nn.CrossEntropyLoss()
+    # built once so nothing in the step allocates a fresh tensor (needed for graph capture)
+    angles = torch.arange(4, device='cuda' if use_gpu else 'cpu')
     max_acc = 0
+    saver = ThreadPoolExecutor(max_workers=1)
+    pending_save = None
+
+    def rotation_step(x, y):
+        x_, y_, a_ = rotate_batch(x, y, angles)
+
+        with torch.autocast('cuda', dtype=amp_dtype, enabled=use_amp, cache_enabled=not use_graph):
+            f, scores = model.forward(x_)
+            rotate_scores = rotate_classifier(f)
+            rloss = lossfn(rotate_scores, a_)
+            closs = lossfn(scores, y_)
+            loss = 0.5 * closs + 0.5 * rloss
+
+        optimizer.zero_grad(set_to_none=True)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        return closs.detach(), rloss.detach()
 
-    print("stop_epoch", start_epoch, stop_epoch)
+    if is_main_process(params):
+        print("stop_epoch", start_epoch, stop_epoch)
 
     for epoch in range(start_epoch, stop_epoch):
+        if params.distributed:
+            base_loader.sampler.set_epoch(epoch)
         rotate_classifier.train()
         model.train()
 
@@ -125,93 +273,66 @@ def train_rotation(base_loader, base_loader_test, model, start_epoch, stop_epoch
         avg_rloss = 0
 
         for i, (x, y) in enumerate(base_loader):
-            bs = x.size(0)
-            x_ = []
-            y_ = []
-            a_ = []
-            for j in range(bs):
-                x90 = x[j].transpose(2, 1).flip(1)
-                x180 = x90.transpose(2, 1).flip(1)
-                x270 = x180.transpose(2, 1).flip(1)
-                x_ += [x[j], x90, x180, x270]
-                y_ += [y[j] for _ in range(4)]
-                a_ += [torch.tensor(0), torch.tensor(1), torch.tensor(2), torch.tensor(3)]
-
-            x_ = Variable(torch.stack(x_, 0))
-            y_ = Variable(torch.stack(y_, 0))
-            a_ = Variable(torch.stack(a_, 0))
-
             if use_gpu:
-                x_ = x_.cuda()
-                y_ = y_.cuda()
-                a_ = a_.cuda()
-
-            f, scores = model.forward(x_)
-            rotate_scores = rotate_classifier(f)
-
-            optimizer.zero_grad()
-            rloss = lossfn(rotate_scores, a_)
-            closs = lossfn(scores, y_)
-            loss = 0.5 * closs + 0.5 * rloss
-            loss.backward()
-            optimizer.step()
-
-            avg_loss = avg_loss + closs.data.item()
-            avg_rloss = avg_rloss + rloss.data.item()
-
-            if i % 50 == 0:
+                x, y = x.cuda(non_blocking=True), y.cuda(non_blocking=True)
+
+            if use_graph:
+                if graph is None:
+                    static_x, static_y = x.clone(), y.clone()
+                    graph, (static_closs, static_rloss) = capture_cuda_graph(rotation_step, [model, rotate_head],
+                                                                             optimizer, static_x, static_y)
+                static_x.copy_(x)
+                static_y.copy_(y)
+                graph.replay()
+                closs, rloss = static_closs, static_rloss
+            else:
+                closs, rloss = rotation_step(x, y)
+
+            avg_loss = avg_loss + closs
+            avg_rloss = avg_rloss + rloss
+
+            if i % 50 == 0 and is_main_process(params):
                 print('Epoch {:d} | Batch {:d}/{:d} | Loss {:f} | Rotate Loss {:f}'.format(epoch, i, len(base_loader),
-                                                                                           avg_loss / float(i + 1),
-                                                                                           avg_rloss / float(i + 1)))
+                                                                                           avg_loss.item() / float(i + 1),
+                                                                                           avg_rloss.item() / float(i + 1)))
 
-        if not os.path.isdir(params.checkpoint_dir):
-            os.makedirs(params.checkpoint_dir)
-
-        if (epoch % params.save_freq == 0) or (epoch == stop_epoch - 1):
+        if ((epoch % params.save_freq == 0) or (epoch == stop_epoch - 1)) and is_main_process(params):
             outfile = os.path.join(params.checkpoint_dir, '{:d}.tar'.format(epoch))
-            torch.save({'epoch': epoch, 'state': model.state_dict(), 'rotate': rotate_classifier.state_dict()}, outfile)
-
-        model.eval()
-        rotate_classifier.eval()
-
-        with torch.no_grad():
-            correct = rcorrect = total = 0
-            for i, (x, y) in enumerate(base_loader_test):
-                if i < 10:
-                    bs = x.size(0)
-                    x_ = []
-                    y_ = []
-                    a_ = []
-                    for j in range(bs):
-                        x90 = x[j].transpose(2, 1).flip(1)
-                        x180 = x90.transpose(2, 1).flip(1)
-                        x270 = x180.transpose(2, 1).flip(1)
-                        x_ += [x[j], x90, x180, x270]
-                        y_ += [y[j] for _ in range(4)]
-                        a_ += [torch.tensor(0), torch.tensor(1), torch.tensor(2), torch.tensor(3)]
-
-                    x_ = Variable(torch.stack(x_, 0))
-                    y_ = Variable(torch.stack(y_, 0))
-                    a_ = Variable(torch.stack(a_, 0))
-
-                    if use_gpu:
-                        x_ = x_.cuda()
-                        y_ = y_.cuda()
-                        a_ = a_.cuda()
-
-                    f, scores = model(x_)
-                    rotate_scores = rotate_classifier(f)
-                    p1 = torch.argmax(scores, 1)
-                    correct += (p1 == y_).sum().item()
-                    total += p1.size(0)
-                    p2 = torch.argmax(rotate_scores, 1)
-                    rcorrect += (p2 == a_).sum().item()
-
-            print("Epoch {0} : Accuracy {1}, Rotate Accuracy {2}".format(epoch, (float(correct) * 100) / total,
-                                                                         (float(rcorrect) * 100) / total))
-
-        torch.cuda.empty_cache()
-
+            if pending_save is not None:
+                pending_save.result()
+            pending_save = saver.submit(torch.save, {'epoch': epoch, 'state': cpu_state_dict(model),
+                                                     'rotate': cpu_state_dict(rotate_head)}, outfile)
+
+        if is_main_process(params):
+            eval_model = model.module if params.distributed else model
+            eval_model.eval()
+            rotate_head.eval()
+
+            with torch.no_grad():
+                correct = torch.zeros((), dtype=torch.long, device=angles.device)
+                rcorrect = torch.zeros((), dtype=torch.long, device=angles.device)
+                total = 0
+                for i, (x, y) in enumerate(base_loader_test):
+                    if i < 10:
+                        if use_gpu:
+                            x, y = x.cuda(non_blocking=True), y.cuda(non_blocking=True)
+                        x_, y_, a_ = rotate_batch(x, y, angles)
+
+                        f, scores = eval_model(x_)
+                        rotate_scores = rotate_head(f)
+                        p1 = torch.argmax(scores, 1)
+                        correct += (p1 == y_).sum()
+                        total += p1.size(0)
+                        p2 = torch.argmax(rotate_scores, 1)
+                        rcorrect += (p2 == a_).sum()
+
+                correct, rcorrect = correct.item(), rcorrect.item()
+                print("Epoch {0} : Accuracy {1}, Rotate Accuracy {2}".format(epoch, (float(correct) * 100) / total,
+                                                                             (float(rcorrect) * 100) / total))
+
+    saver.shutdown(wait=True)
+    if pending_save is not None:
+        pending_save.result()
     return model
 
 
@@ -219,33 +340,75 @@ if __name__ == '__main__':
     params = parse_args('train')
     params.resume = True
 
+    # torchrun sets LOCAL_RANK; plain `python train_cifar.py` stays single-process
+    params.local_rank = int(os.environ.get('LOCAL_RANK', -1))
+    params.distributed = params.local_rank != -1
+    if params.distributed:
+        torch.distributed.init_process_group('nccl')
+        torch.cuda.set_device(params.local_rank)
+        # --batch_size stays the global batch, as on the DataParallel path which splits it across GPUs
+        world_size = torch.distributed.get_world_size()
+        if params.batch_size % world_size != 0:
+            raise ValueError('--batch_size {:d} is not divisible by the {:d} ranks'.format(params.batch_size,
+                                                                                         world_size))
+        params.batch_size //= world_size
+
+    # inputs are a fixed 32x32, so cuDNN autotuning pays off after the first batch
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
 
     image_size = 32
 
     base_file = configs.data_dir[params.dataset] + 'base.json'
     params.checkpoint_dir = '%s/checkpoints/%s/%s_%s' % (configs.save_dir, params.dataset, params.model, params.method)
+    os.makedirs(params.checkpoint_dir, exist_ok=True)
     start_epoch = params.start_epoch
     stop_epoch = params.stop_epoch
 
-    base_datamgr = SimpleDataManager(image_size, batch_size=params.batch_size)
-    base_loader = base_datamgr.get_data_loader(base_file, aug=params.train_aug)
-    base_datamgr_test = SimpleDataManager(image_size, batch_size=params.test_batch_size)
-    base_loader_test = base_datamgr_test.get_data_loader(base_file, aug=False)
+    base_datamgr = SimpleDataManager(image_size, batch_size=params.batch_size, num_workers=params.num_workers)
+    # a constant batch shape keeps the cuDNN plan cache (and a captured CUDA graph) valid
+    base_loader = base_datamgr.get_data_loader(base_file, aug=params.train_aug, distributed=params.distributed,
+                                               drop_last=True, pin_memory=True, persistent_workers=True)
+    base_datamgr_test = SimpleDataManager(image_size, batch_size=params.test_batch_size,
+                                          num_workers=params.num_workers)
+    base_loader_test = base_datamgr_test.get_data_loader(base_file, aug=False, pin_memory=True,
+                                                         persistent_workers=True)
+    if use_gpu:
+        base_loader = CudaPrefetcher(base_loader)
 
     if params.model == 'WideResNet28_10':
         model = wrn_mixup_model.wrn28_10(num_classes=64)
     elif params.model == 'ResNet18':
         model = res_mixup_model.resnet18(num_classes=64)
 
+    if params.cuda_graph:
+        # only the rotation step is captured, and GradScaler and multi-GPU wrappers cannot be
+        if params.method != 'rotation':
+            raise ValueError('--cuda_graph is only supported with --method rotation')
+        if not use_gpu or params.distributed or torch.cuda.device_count() > 1:
+            raise ValueError('--cuda_graph requires a single-GPU, non-torchrun run')
+        if params.amp_dtype == 'float16':
+            raise ValueError('--cuda_graph cannot capture the float16 GradScaler; use --amp_dtype bfloat16')
+
+    if params.compile:
+        # Module.compile binds to the original module, so DataParallel replicas on other GPUs would run it
+        # with cuda:0's parameters; DDP keeps one module per process
+        if not params.distributed and torch.cuda.device_count() > 1:
+            raise ValueError('--compile with more than one GPU requires launching through torchrun (DDP)')
+        compile_backbone(model, params)
+
+    # load checkpoints straight onto this process's GPU from a memory-mapped file
+    map_location = 'cuda:{:d}'.format(torch.cuda.current_device()) if use_gpu else 'cpu'
+
     if params.method == 'S2M2_R':
 
-        model = torch.nn.DataParallel(model, device_ids=range(torch.cuda.device_count()))
-        model.cuda()
+        model = wrap_model(model, params)
 
         if params.resume:
             resume_file = get_resume_file(params.checkpoint_dir)
             print("resume_file", resume_file)
-            tmp = torch.load(resume_file)
+            tmp = load_checkpoint(resume_file, map_location)
             start_epoch = tmp['epoch'] + 1
             print("restored epoch is", tmp['epoch'])
             state = tmp['state']
@@ -267,7 +430,7 @@ if __name__ == '__main__':
             resume_rotate_file_dir = params.checkpoint_dir.replace("S2M2_R", "rotation")
             resume_file = get_resume_file(resume_rotate_file_dir)
             print("resume_file", resume_file)
-            tmp = torch.load(resume_file)
+            tmp = load_checkpoint(resume_file, map_location)
             start_epoch = tmp['epoch'] + 1
             print("restored epoch is", tmp['epoch'])
             state = tmp['state']
@@ -289,18 +452,22 @@ if __name__ == '__main__':
 
 
     elif params.method == 'rotation':
-        if use_gpu:
-            if torch.cuda.device_count() > 1:
-                model = torch.nn.DataParallel(model, device_ids=range(torch.cuda.device_count()))
+        model = model.to(memory_format=torch.channels_last)
+        if params.distributed or torch.cuda.device_count() > 1:
+            model = wrap_model(model, params)
+        elif use_gpu:
             model.cuda()
 
         if params.resume:
             resume_file = get_resume_file(params.checkpoint_dir)
             print("resume_file", resume_file)
-            tmp = torch.load(resume_file)
+            tmp = load_checkpoint(resume_file, map_location)
             start_epoch = tmp['epoch'] + 1
             print("restored epoch is", tmp['epoch'])
             state = tmp['state']
             model.load_state_dict(state)
 
         model = train_rotation(base_loader, base_loader_test, model, start_epoch, stop_epoch, params, None)
+
+    if params.distributed:
+        torch.distributed.destroy_process_group()